@@ -17,17 +17,24 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import gzip
 import itertools
 import multiprocessing as mp
 import numpy as np
+import os
 import random
 import shufflebuffer as sb
 import struct
-import tensorflow as tf
+import tempfile
 import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = struct.pack('i', 3)
 STRUCT_STRING = '4s7432s832sBBBBBBBb'
+V3_BYTES = struct.calcsize(STRUCT_STRING)
+READ_BUFFER_SIZE = 128*1024
 
 # Interface for a chunk data source.
 class ChunkDataSrc:
@@ -39,6 +46,146 @@ class ChunkDataSrc:
         return self.items.pop()
 
 
+def inflate(filename):
+    """
+        Read a gzip file in large blocks through zlib directly, without the
+        small reads and buffer copies of gzip.open.
+
+        Returns the bytearray the data was inflated into, rather than
+        copying it to a new bytes object.
+
+        Like gzip.open, this reads concatenated gzip members, skips zero
+        padding after a member and returns nothing for an empty file.
+    """
+    chunkdata = bytearray()
+    decompressor = None
+    with open(filename, 'rb', buffering=0) as chunk_file:
+        data = chunk_file.read(READ_BUFFER_SIZE)
+        while data:
+            if decompressor is None or decompressor.eof:
+                data = data.lstrip(b'\0')
+                if not data:
+                    data = chunk_file.read(READ_BUFFER_SIZE)
+                    continue
+                # wbits for a gzip header and trailer
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunkdata += decompressor.decompress(data)
+            # Only set once a member ends before the data does
+            data = decompressor.unused_data
+            if not data:
+                data = chunk_file.read(READ_BUFFER_SIZE)
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError("{} is truncated".format(filename))
+    return chunkdata
+
+
+class FileDataSrc:
+    """
+        data source yielding chunkdata from chunk files.
+
+        If 'cache_dir' is set, inflated chunks are kept there so later
+        passes over the data skip the gzip decompression.
+
+        The next 'prefetch' chunks are read and inflated on background
+        threads while the current one is parsed.
+    """
+    def __init__(self, chunks, cache_dir=None, prefetch=4):
+        self.chunks = []
+        self.done = chunks
+        self.cache_dir = cache_dir
+        self.prefetch = prefetch
+        # Every parser worker gets its own copy of this object, so the
+        # threads are only started on first use, inside the worker.
+        self.executor = None
+        self.pending = collections.deque()
+        self.cache_failed = False
+
+    def cache_path(self, filename):
+        path = os.path.abspath(filename)[:-len('.gz')]
+        return os.path.join(os.path.abspath(self.cache_dir),
+                            path.lstrip(os.sep))
+
+    def prune_cache(self):
+        """
+            Remove everything in 'cache_dir' that is not the cached copy
+            of one of our chunks, so the cache follows the training window
+            instead of growing with every run.
+        """
+        if self.cache_dir is None:
+            return
+        keep = set(self.cache_path(f) for f in self.chunks + self.done)
+        for root, _, files in os.walk(os.path.abspath(self.cache_dir)):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in keep:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def read(self, filename):
+        if self.cache_dir is None:
+            return inflate(filename)
+        cached = self.cache_path(filename)
+        if os.path.exists(cached):
+            with open(cached, 'rb') as chunk_file:
+                return chunk_file.read()
+        chunkdata = inflate(filename)
+        # All workers share the cache, so write to a private file and
+        # rename it to never expose a partially written chunk.
+        tmp = "{}.{}".format(cached, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(tmp, 'wb') as cache_file:
+                cache_file.write(chunkdata)
+            os.replace(tmp, cached)
+        except OSError as e:
+            # A full or unwritable cache only costs us the speedup.
+            if not self.cache_failed:
+                self.cache_failed = True
+                print("failed to cache {}: {}".format(filename, e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        return chunkdata
+
+    def shard(self, index, count):
+        """
+            A data source over every count-th chunk, starting at index.
+        """
+        chunks = self.chunks + self.done
+        return FileDataSrc(chunks[index::count], self.cache_dir,
+                           self.prefetch)
+
+    def next_filename(self):
+        if not self.chunks:
+            self.chunks, self.done = self.done, self.chunks
+            random.shuffle(self.chunks)
+        if not self.chunks:
+            return None
+        return self.chunks.pop()
+
+    def next(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.prefetch)
+        while True:
+            while len(self.pending) < self.prefetch:
+                filename = self.next_filename()
+                if filename is None:
+                    break
+                self.pending.append(
+                    (filename, self.executor.submit(self.read, filename)))
+            if not self.pending:
+                return None
+            filename, chunkdata = self.pending.popleft()
+            try:
+                chunkdata = chunkdata.result()
+                self.done.append(filename)
+                return chunkdata
+            except:
+                print("failed to parse {}".format(filename))
+
 
 class ChunkParser:
     # static batch size
@@ -47,7 +194,8 @@ class ChunkParser:
         """
         Read data and yield batches of raw tensors.
 
-        'chunkdatasrc' is an object yeilding chunkdata
+        'chunkdatasrc' is an object yeilding chunkdata. If it has a
+        shard(index, count) method, every worker gets its own shard of it.
         'shuffle_size' is the size of the shuffle buffer.
         'sample' is the rate to down-sample.
         'workers' is the number of child workers to use.
@@ -60,17 +208,11 @@ class ChunkParser:
         chunkdata: type Bytes. Multiple records of v3 format where each record
         consists of (state, policy, result)
 
-        raw: A byte string holding raw tensors contenated together. This is
-        used to pass data from the workers to the parent. Exists because
-        TensorFlow doesn't have a fast way to unpack bit vectors. 7950 bytes
-        long.
+        record: A single v3 record. Records are passed from the workers to
+        the parent, shuffled, and concatenated into batches which are
+        decoded into tensors by parse_function, in the TensorFlow graph.
         """
 
-        # Build a series of flat planes with values 0..255
-        self.flat_planes = []
-        for i in range(256):
-            self.flat_planes.append(bytes([i]*64))
-
         # set the down-sampling rate
         self.sample = sample
         # set the mini-batch size
@@ -83,17 +225,24 @@ class ChunkParser:
 
         print("Using {} worker processes.".format(workers))
 
-        # Start the child workers running
-        self.readers = []
-        self.writers = []
-        self.processes = []
-        for _ in range(workers):
+        # Start the child workers running. Each worker gets a pickled copy
+        # of this object, which can't hold the started processes yet.
+        readers = []
+        writers = []
+        processes = []
+        for i in range(workers):
             read, write = mp.Pipe(duplex=False)
-            p = mp.Process(target=self.task, args=(chunkdatasrc, write))
-            self.processes.append(p)
+            src = chunkdatasrc
+            if hasattr(chunkdatasrc, 'shard'):
+                src = chunkdatasrc.shard(i, workers)
+            p = mp.Process(target=self.task, args=(src, write))
             p.start()
-            self.readers.append(read)
-            self.writers.append(write)
+            processes.append(p)
+            readers.append(read)
+            writers.append(write)
+        self.readers = readers
+        self.writers = writers
+        self.processes = processes
         self.init_structs()
 
 
@@ -129,57 +278,58 @@ class ChunkParser:
 
 
     @staticmethod
-    def parse_function(planes, probs, winner):
+    def parse_function(records):
         """
-        Convert unpacked record batches to tensors for tensorflow training
+        Decode a batch of v3 records, concatenated or as a vector of
+        strings, to tensors for tensorflow training. See init_structs for
+        the record layout.
         """
-        planes = tf.decode_raw(planes, tf.uint8)
-        probs = tf.decode_raw(probs, tf.float32)
-        winner = tf.decode_raw(winner, tf.float32)
-
-        planes = tf.to_float(planes)
-        planes = tf.reshape(planes, (ChunkParser.BATCH_SIZE, 112, 8*8))
-
-        probs = tf.reshape(probs, (ChunkParser.BATCH_SIZE, 1858))
+        # TensorFlow is imported where it is used, so that the parser
+        # workers never load it.
+        import tensorflow as tf
+        records = tf.decode_raw(records, tf.uint8)
+        records = tf.reshape(records, (ChunkParser.BATCH_SIZE, V3_BYTES))
+
+        # 1858 float32 probabilities after the version.
+        probs = tf.reshape(records[:, 4:7436], (ChunkParser.BATCH_SIZE, 1858, 4))
+        probs = tf.bitcast(probs, tf.float32)
+
+        # The packed bit planes and the castling, side to move and rule50
+        # bytes are left as they are, see unpack_planes.
+        planes = records[:, 7436:8274]
+
+        winner = tf.bitcast(records[:, 8275], tf.int8)
+        winner = tf.to_float(winner)
         winner = tf.reshape(winner, (ChunkParser.BATCH_SIZE, 1))
 
         return (planes, probs, winner)
 
 
-    def convert_v3_to_tuple(self, content):
+    @staticmethod
+    def unpack_planes(planes):
         """
-        Unpack a v3 binary record to 3-tuple (state, policy pi, result)
-
-        v3 struct format is (8276 bytes total)
-            int32 version (4 bytes)
-            1858 float32 probabilities (7432 bytes)
-            104 (13*8) packed bit planes of 8 bytes each (832 bytes)
-            uint8 castling us_ooo (1 byte)
-            uint8 castling us_oo (1 byte)
-            uint8 castling them_ooo (1 byte)
-            uint8 castling them_oo (1 byte)
-            uint8 side_to_move (1 byte)
-            uint8 rule50_count (1 byte)
-            uint8 move_count (1 byte)
-            int8 result (1 byte)
+        Expand the packed planes from parse_function to 112 uint8 input
+        planes, channels last. Meant to run on the GPU, so only the packed
+        838 bytes per position are copied to the device.
         """
-        (ver, probs, planes, us_ooo, us_oo, them_ooo, them_oo, stm, rule50_count, move_count, winner) = self.v3_struct.unpack(content)
-        # Enforce move_count to 0
-        move_count = 0
-
-        # Unpack bit planes
-        planes = np.unpackbits(np.frombuffer(planes, dtype=np.uint8))
-
-        # Concatenate all byteplanes. Make the last plane all 1's so the NN can
-        # detect edges of the board more easily
-        planes = planes.tobytes() + self.flat_planes[us_ooo] + self.flat_planes[us_oo] + self.flat_planes[them_ooo] + self.flat_planes[them_oo] + self.flat_planes[stm] + self.flat_planes[rule50_count] + self.flat_planes[move_count] + self.flat_planes[1]
-
-        assert len(planes) == ((8*13*1 + 8*1*1) * 8 * 8)
-        winner = float(winner)
-        assert winner == 1.0 or winner == -1.0 or winner == 0.0
-        winner = struct.pack('f', winner)
-
-        return (planes, probs, winner)
+        import tensorflow as tf
+        # Unpack the 104 bit planes, most significant bit first.
+        bit_planes = tf.reshape(planes[:, :832], (-1, 104, 8, 1))
+        bits = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.uint8)
+        bit_planes = tf.bitwise.bitwise_and(bit_planes, bits)
+        bit_planes = tf.cast(tf.not_equal(bit_planes, 0), tf.uint8)
+        bit_planes = tf.reshape(bit_planes, (-1, 104, 8*8))
+
+        # Castling, side to move and rule50 as flat planes. move_count is
+        # enforced to 0 and the last plane is all 1's so the NN can detect
+        # edges of the board more easily.
+        flat = tf.concat([planes[:, 832:838],
+                          tf.zeros_like(planes[:, :1]),
+                          tf.ones_like(planes[:, :1])], 1)
+        flat = tf.tile(tf.expand_dims(flat, -1), [1, 1, 8*8])
+        planes = tf.concat([bit_planes, flat], 1)
+        # The network is NHWC, so channels go last.
+        return tf.transpose(planes, [0, 2, 1])
 
 
     def sample_record(self, chunkdata):
@@ -205,32 +355,38 @@ class ChunkParser:
             chunkdata = chunkdatasrc.next()
             if chunkdata is None:
                 break
-            for item in self.sample_record(chunkdata):
-                # NOTE: This requires some more thinking, we can't just apply a
-                # reflection along the horizontal or vertical axes as we would
-                # also have to apply the reflection to the move probabilities
-                # which is non trivial for chess.
-                writer.send_bytes(item)
+            # NOTE: This requires some more thinking, we can't just apply a
+            # reflection along the horizontal or vertical axes as we would
+            # also have to apply the reflection to the move probabilities
+            # which is non trivial for chess.
+            # Send all the records sampled from a chunk in one message.
+            items = b''.join(self.sample_record(chunkdata))
+            if items:
+                writer.send_bytes(items)
 
 
     def v3_gen(self):
         """
-        Read v3 records from child workers, shuffle, and yield
-        records.
+        Read v3 records from child workers in arrival order, shuffle,
+        and yield records.
         """
         sbuff = sb.ShuffleBuffer(self.v3_struct.size, self.shuffle_size)
         while len(self.readers):
-            #for r in mp.connection.wait(self.readers):
-            for r in self.readers:
+            # Take records from whichever workers are ready rather than
+            # round-robin, so a worker busy inflating a chunk doesn't
+            # stall the others.
+            for r in mp.connection.wait(self.readers):
                 try:
-                    s = r.recv_bytes()
-                    s = sbuff.insert_or_replace(s)
-                    if s is None:
-                        continue  # shuffle buffer not yet full
-                    yield s
+                    items = r.recv_bytes()
                 except EOFError:
                     print("Reader EOF")
                     self.readers.remove(r)
+                    continue
+                for i in range(0, len(items), self.v3_struct.size):
+                    s = sbuff.insert_or_replace(items[i:i+self.v3_struct.size])
+                    if s is None:
+                        continue  # shuffle buffer not yet full
+                    yield s
         # drain the shuffle buffer.
         while True:
             s = sbuff.extract()
@@ -239,36 +395,22 @@ class ChunkParser:
             yield s
 
 
-    def tuple_gen(self, gen):
-        """
-        Take a generator producing v3 records and convert them to tuples.
-        applying a random symmetry on the way.
-        """
-        for r in gen:
-            yield self.convert_v3_to_tuple(r)
-
-
     def batch_gen(self, gen):
         """
         Pack multiple records into a single batch
         """
-        # Get N records. We flatten the returned generator to
-        # a list because we need to reuse it.
         while True:
             s = list(itertools.islice(gen, self.batch_size))
             if not len(s):
                 return
-            yield ( b''.join([x[0] for x in s]),
-                    b''.join([x[1] for x in s]),
-                    b''.join([x[2] for x in s]) )
+            yield b''.join(s)
 
 
     def parse(self):
         """
-        Read data from child workers and yield batches of unpacked records
+        Read data from child workers and yield batches of v3 records
         """
         gen = self.v3_gen()        # read from workers
-        gen = self.tuple_gen(gen)  # convert v3->tuple
         gen = self.batch_gen(gen)  # assemble into batches
         for b in gen:
             yield b
@@ -311,6 +453,135 @@ class ChunkParserTest(unittest.TestCase):
         return self.v3_struct.pack(VERSION, pi, pl, i[0], i[1], i[2], i[3], i[4], i[5], i[6], winner)
 
 
+    def write_chunks(self, dirname, count):
+        """
+        Write 'count' gzipped chunks of one record each, return their names.
+        """
+        chunks = []
+        for i in range(count):
+            chunk = os.path.join(dirname, 'training.{}.gz'.format(i))
+            with gzip.open(chunk, 'wb') as chunk_file:
+                chunk_file.write(self.v3_record(*self.generate_fake_pos()))
+            chunks.append(chunk)
+        return chunks
+
+
+    def test_inflate(self):
+        """
+        Test inflating gzip files the way gzip.open reads them.
+        """
+        first = self.v3_record(*self.generate_fake_pos())
+        second = self.v3_record(*self.generate_fake_pos())
+        # A stored member that ends exactly at the end of the first read
+        big = os.urandom(READ_BUFFER_SIZE)
+        for n in range(READ_BUFFER_SIZE - 1024, READ_BUFFER_SIZE):
+            member = gzip.compress(big[:n], compresslevel=0)
+            if len(member) >= READ_BUFFER_SIZE:
+                big = big[:n]
+                break
+        self.assertEqual(len(member), READ_BUFFER_SIZE)
+
+        cases = [
+            (b'', b''),
+            (gzip.compress(first), first),
+            (gzip.compress(first) + gzip.compress(second), first + second),
+            (member + gzip.compress(second), big + second),
+            (gzip.compress(first) + bytes(READ_BUFFER_SIZE + 1), first),
+            (gzip.compress(first) + bytes(16) + gzip.compress(second),
+             first + second),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            chunk = os.path.join(tmp, 'training.gz')
+            for data, chunkdata in cases:
+                with open(chunk, 'wb') as chunk_file:
+                    chunk_file.write(data)
+                self.assertEqual(inflate(chunk), chunkdata)
+                with gzip.open(chunk, 'rb') as chunk_file:
+                    self.assertEqual(chunk_file.read(), chunkdata)
+
+            with open(chunk, 'wb') as chunk_file:
+                chunk_file.write(gzip.compress(first)[:-4])
+            with self.assertRaises(EOFError):
+                inflate(chunk)
+
+
+    def test_file_data_src(self):
+        """
+        Test the order, retries and failures of FileDataSrc.next.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            chunks = self.write_chunks(tmp, 12)
+            names = {}
+            for chunk in chunks:
+                with gzip.open(chunk, 'rb') as chunk_file:
+                    names[chunk_file.read()] = chunk
+            bad = os.path.join(tmp, 'training.bad.gz')
+            with open(bad, 'wb') as chunk_file:
+                chunk_file.write(b'not a chunk')
+
+            src = FileDataSrc(chunks + [bad], prefetch=4)
+            # Every good chunk once per pass, the bad one is dropped
+            first = [names[bytes(src.next())] for _ in chunks]
+            self.assertEqual(sorted(first), sorted(chunks))
+            # Chunks still being read when a pass ends join the next one,
+            # so they all come back within the next two passes.
+            self.assertTrue(src.pending)
+            later = [names[bytes(src.next())] for _ in 2 * chunks]
+            self.assertEqual(set(later), set(chunks))
+
+            src = FileDataSrc([bad, bad], prefetch=4)
+            self.assertIsNone(src.next())
+
+
+    def test_shard(self):
+        """
+        Test that worker shards split the chunks between them.
+        """
+        chunks = ['training.{}.gz'.format(i) for i in range(10)]
+        src = FileDataSrc(list(chunks), cache_dir='/cache', prefetch=2)
+        for count in range(1, 4):
+            shards = [src.shard(i, count) for i in range(count)]
+            sharded = [c for shard in shards for c in shard.done]
+            self.assertEqual(sorted(sharded), sorted(chunks))
+            for shard in shards:
+                self.assertEqual(shard.cache_dir, '/cache')
+                self.assertEqual(shard.prefetch, 2)
+
+
+    def test_chunk_cache(self):
+        """
+        Test caching inflated chunks, pruning the cache and falling back
+        to the chunk itself when the cache can't be written.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            chunks = self.write_chunks(tmp, 2)
+            expected = []
+            for chunk in chunks:
+                with gzip.open(chunk, 'rb') as chunk_file:
+                    expected.append(chunk_file.read())
+
+            cache_dir = os.path.join(tmp, 'cache')
+            src = FileDataSrc(chunks, cache_dir)
+            for chunk, chunkdata in zip(chunks, expected):
+                self.assertEqual(src.read(chunk), chunkdata)
+                self.assertTrue(os.path.exists(src.cache_path(chunk)))
+                self.assertEqual(src.read(chunk), chunkdata)
+
+            stale = os.path.join(cache_dir, 'training.stale')
+            open(stale, 'wb').close()
+            FileDataSrc(chunks[:1], cache_dir).prune_cache()
+            self.assertTrue(os.path.exists(src.cache_path(chunks[0])))
+            self.assertFalse(os.path.exists(src.cache_path(chunks[1])))
+            self.assertFalse(os.path.exists(stale))
+
+            # A file where the cache directory should be
+            blocked = os.path.join(tmp, 'blocked')
+            open(blocked, 'wb').close()
+            src = FileDataSrc(chunks, blocked)
+            self.assertEqual(src.read(chunks[1]), expected[1])
+            self.assertTrue(src.cache_failed)
+
+
     def test_structsize(self):
         """
         Test struct size
@@ -320,7 +591,7 @@ class ChunkParserTest(unittest.TestCase):
 
     def test_parsing(self):
         """
-        Test game position decoding pipeline.
+        Test game position batching pipeline.
         """
         truth = self.generate_fake_pos()
         batch_size = 4
@@ -334,18 +605,12 @@ class ChunkParserTest(unittest.TestCase):
         parser = ChunkParser(ChunkDataSrc(records), shuffle_size=1, workers=1, batch_size=batch_size)
         batchgen = parser.parse()
         data = next(batchgen)
-        
-        batch = ( np.reshape(np.frombuffer(data[0], dtype=np.uint8), (batch_size, 112, 64)),
-                  np.reshape(np.frombuffer(data[1], dtype=np.int32), (batch_size, 1858)),
-                  np.reshape(np.frombuffer(data[2], dtype=np.float32), (batch_size, 1)) )
 
+        self.assertEqual(len(data), batch_size * V3_BYTES)
         for i in range(batch_size):
-            data = (batch[0][i][:104], np.array([batch[0][i][j][0] for j in range(104,111)]), batch[1][i], batch[2][i])
-            self.assertTrue((data[0] == truth[0]).all())
-            self.assertTrue((data[1] == truth[1]).all())
-            self.assertTrue((data[2] == truth[2]).all())
-            self.assertEqual(data[3][0], truth[3])
-            
+            record = data[i*V3_BYTES:(i+1)*V3_BYTES]
+            self.assertEqual(record, self.v3_record(*truth))
+
         parser.shutdown()
 
 
@@ -353,6 +618,8 @@ class ChunkParserTest(unittest.TestCase):
         """
         Test game position decoding pipeline including tensorflow.
         """
+        import tensorflow as tf
+
         truth = self.generate_fake_pos()
         batch_size = 4
         ChunkParser.BATCH_SIZE = batch_size
@@ -367,22 +634,19 @@ class ChunkParserTest(unittest.TestCase):
         batchgen = parser.parse()
         data = next(batchgen)
 
-        planes = np.frombuffer(data[0], dtype=np.uint8, count=112*8*8*batch_size)
-        planes = planes.reshape(batch_size, 112, 8*8)
-        planes = planes.astype(np.float32)
-        probs = np.frombuffer(data[1], dtype=np.float32, count=1858*batch_size)
-        probs = probs.reshape(batch_size, 1858)
-        winner = np.frombuffer(data[2], dtype=np.float32, count=1*batch_size)
-
         # Pass it through tensorflow
         with tf.Session() as sess:
-            graph = ChunkParser.parse_function(data[0], data[1], data[2])
-            tf_planes, tf_probs, tf_winner = sess.run(graph)
+            planes, probs, winner = ChunkParser.parse_function(data)
+            planes = ChunkParser.unpack_planes(planes)
+            tf_planes, tf_probs, tf_winner = sess.run([planes, probs, winner])
+            self.assertEqual(tf_planes.dtype, np.uint8)
 
             for i in range(batch_size):
-                self.assertTrue((probs[i] == tf_probs[i]).all())
-                self.assertTrue((planes[i] == tf_planes[i]).all())
-                self.assertTrue((winner[i] == tf_winner[i]).all())
+                self.assertTrue((tf_planes[i][:, :104].T == truth[0]).all())
+                self.assertTrue((tf_planes[i][0, 104:111] == truth[1]).all())
+                self.assertTrue((tf_planes[i][:, 111] == 1).all())
+                self.assertTrue((tf_probs[i].view(np.int32) == truth[2]).all())
+                self.assertEqual(tf_winner[i][0], truth[3])
 
         parser.shutdown()
 
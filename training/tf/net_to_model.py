@@ -65,7 +65,7 @@ cfg['name'] = 'online-{}x{}'.format(filters, blocks)
 print(yaml.dump(cfg, default_flow_style=False))
 
 x = [
-    tf.placeholder(tf.float32, [None, 112, 8*8]),
+    tf.placeholder(tf.uint8, [None, 838]),
     tf.placeholder(tf.float32, [None, 1858]),
     tf.placeholder(tf.float32, [None, 1])
     ]
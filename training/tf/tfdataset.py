@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Zero.
+#    Copyright (C) 2017 Gian-Carlo Pascutto
+#
+#    Leela Zero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Zero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Zero.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tensorflow as tf
+from chunkparser import ChunkParser, READ_BUFFER_SIZE, V3_BYTES, VERSION
+
+
+def dataset_options():
+    """
+        tf.data options applied to every input pipeline.
+    """
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.shuffle_and_repeat_fusion = True
+    # Batches are shuffled anyway, so don't stall on ordering.
+    options.experimental_deterministic = False
+    # Run the pipeline on its own threads, so decoding never competes with
+    # the training ops for the inter-op pool, and keep each pipeline op
+    # single threaded to avoid oversubscribing the cores.
+    threads = options.experimental_threading
+    threads.private_threadpool_size = max(4, os.cpu_count() - 2)
+    threads.max_intra_op_parallelism = 1
+    return options
+
+
+def make_dataset(parser):
+    """
+        Build the tf.data pipeline on top of a ChunkParser.
+
+        The pipeline is bound by I/O and memory traffic, not compute: the
+        workers inflate and sample chunks and the graph only reinterprets
+        bytes. Besides the parser's shuffle buffer, data is held in the
+        chunks each worker reads ahead, the batches the parallel map keeps
+        in flight and the batches prefetched to the GPU.
+    """
+    dataset = tf.data.Dataset.from_generator(
+        parser.parse, output_types=tf.string)
+    return decode_dataset(dataset)
+
+
+def make_record_dataset(chunks, shuffle_size, sample):
+    """
+        Build the tf.data pipeline straight from the chunk files.
+
+        An inflated chunk is a sequence of fixed size v3 records, so tf.data
+        can read, sample and shuffle them without a Python generator in
+        the loop. Like ChunkParser, keeps 1/'sample' of the records.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(chunks)
+    dataset = dataset.shuffle(len(chunks)).repeat()
+    # Chunks that are truncated or still being written end their file's
+    # records instead of the run, like FileDataSrc skipping them.
+    dataset = dataset.interleave(
+        lambda chunk: tf.data.FixedLengthRecordDataset(
+            chunk, V3_BYTES, buffer_size=READ_BUFFER_SIZE,
+            compression_type='GZIP').apply(
+                tf.data.experimental.ignore_errors()),
+        cycle_length=max(1, os.cpu_count() - 2),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.filter(lambda record: tf.logical_and(
+        tf.equal(tf.substr(record, 0, 4), VERSION),
+        tf.random_uniform([]) < 1.0 / sample))
+    dataset = dataset.shuffle(shuffle_size)
+    dataset = dataset.batch(ChunkParser.BATCH_SIZE, drop_remainder=True)
+    return decode_dataset(dataset)
+
+
+def decode_dataset(dataset):
+    """
+        Decode batches of v3 records and prefetch them to the GPU.
+    """
+    # Decode a batch while the next one is assembled.
+    dataset = dataset.map(ChunkParser.parse_function,
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.with_options(dataset_options())
+    dataset = dataset.apply(
+        tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+    return dataset
@@ -21,17 +21,21 @@ import os
 import random
 import tensorflow as tf
 import time
-import bisect
+from chunkparser import ChunkParser
+from tensorflow.contrib.compiler import jit
 
 NUM_STEP_TRAIN = 200
 NUM_STEP_TEST = 2000
 VERSION = 2
 
+# Weights are resource variables throughout: XLA can only compile the
+# optimizer and batchnorm updates of resource variables, not of the
+# legacy reference ones.
 def weight_variable(shape):
     """Xavier initialization"""
     stddev = np.sqrt(2.0 / (sum(shape)))
     initial = tf.truncated_normal(shape, stddev=stddev)
-    weights = tf.Variable(initial)
+    weights = tf.Variable(initial, use_resource=True)
     tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights)
     return weights
 
@@ -40,18 +44,28 @@ def weight_variable(shape):
 # added to the regularlizer collection
 def bias_variable(shape):
     initial = tf.constant(0.0, shape=shape)
-    return tf.Variable(initial)
+    return tf.Variable(initial, use_resource=True)
 
 # No point in learning bias weights as they are cancelled
-# out by the BatchNorm layers's mean adjustment.
+# out by the BatchNorm layers's mean adjustment. They are
+# only exported, the engine subtracts them from the mean.
 def bn_bias_variable(shape):
     initial = tf.constant(0.0, shape=shape)
-    return tf.Variable(initial, trainable=False)
+    return tf.Variable(initial, trainable=False, use_resource=True)
 
 def conv2d(x, W):
-    return tf.nn.conv2d(x, W, data_format='NCHW',
+    # Weights are kept in fp32, compute in the precision of the input.
+    W = tf.cast(W, x.dtype)
+    return tf.nn.conv2d(x, W, data_format='NHWC',
                         strides=[1, 1, 1, 1], padding='SAME')
 
+def nhwc_rows(W, channels):
+    # Fully connected weights on a flattened 8x8 convolution output are
+    # stored in Leela's NCHW row order. Permuting the rows to NHWC is
+    # cheaper than transposing the activations of the whole batch.
+    W = tf.transpose(tf.reshape(W, [channels, 8, 8, -1]), [1, 2, 0, 3])
+    return tf.reshape(W, [8*8*channels, -1])
+
 class TFProcess:
     def __init__(self, cfg):
         self.cfg = cfg
@@ -66,24 +80,50 @@ class TFProcess:
 
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.90, allow_growth=True, visible_device_list="{}".format(self.cfg['gpu']))
         config = tf.ConfigProto(gpu_options=gpu_options)
+        # Let XLA fuse the small conv/batchnorm/relu ops of the tower.
+        self.xla = self.cfg['training'].get('xla', True)
+        if self.xla:
+            config.graph_options.optimizer_options.global_jit_level = \
+                tf.OptimizerOptions.ON_1
         self.session = tf.Session(config=config)
 
+        # Precision of the tower and heads. Weights, batchnorm statistics
+        # and losses stay in fp32.
+        precisions = {'fp32': tf.float32, 'fp16': tf.float16}
+        precision = self.cfg['training'].get('mixed_precision', 'fp32')
+        if precision not in precisions:
+            raise ValueError("Unsupported mixed_precision {}, use one of {}".format(
+                precision, ", ".join(sorted(precisions))))
+        self.model_dtype = precisions[precision]
+
         self.training = tf.placeholder(tf.bool)
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
-        self.learning_rate = tf.placeholder(tf.float32)
 
     def init(self, dataset, train_iterator, test_iterator):
         # TF variables
         self.handle = tf.placeholder(tf.string, shape=[])
-        iterator = tf.data.Iterator.from_string_handle(
-            self.handle, dataset.output_types, dataset.output_shapes)
-        self.next_batch = iterator.get_next()
+        # The datasets are prefetched into GPU memory, so the iterator
+        # that switches between them has to live there as well.
+        with tf.device('/gpu:0'):
+            iterator = tf.data.Iterator.from_string_handle(
+                self.handle, dataset.output_types, dataset.output_shapes)
+            self.next_batch = iterator.get_next()
         self.train_handle = self.session.run(train_iterator.string_handle())
         self.test_handle = self.session.run(test_iterator.string_handle())
         self.init_net(self.next_batch)
 
+        # Callables skip the per call feed and fetch handling of
+        # session.run, which adds up over the many small test batches.
+        self.train_step = self.session.make_callable(
+            [self.train_op, self.step], feed_list=[self.training, self.handle])
+        if self.accumulate_steps > 1:
+            self.accumulate_step = self.session.make_callable(
+                self.accumulate_op, feed_list=[self.training, self.handle])
+        self.test_step = self.session.make_callable(
+            self.test_op, feed_list=[self.training, self.handle])
+
     def init_net(self, next_batch):
-        self.x = next_batch[0]  # tf.placeholder(tf.float32, [None, 112, 8*8])
+        self.x = next_batch[0]  # tf.placeholder(tf.uint8, [None, 838])
         self.y_ = next_batch[1] # tf.placeholder(tf.float32, [None, 1858])
         self.z_ = next_batch[2] # tf.placeholder(tf.float32, [None, 1])
         self.batch_norm_count = 0
@@ -111,10 +151,14 @@ class TFProcess:
         val_loss_w = self.cfg['training']['value_loss_weight']
         loss = pol_loss_w * self.policy_loss + val_loss_w * self.mse_loss + self.reg_term
 
-        # Set adaptive learning rate during training
+        # Set adaptive learning rate during training, the schedule restarts
+        # every total_steps.
         self.cfg['training']['lr_boundaries'].sort()
         self.cfg['training']['lr_values'].sort(reverse=True)
-        self.lr = self.cfg['training']['lr_values'][0]
+        self.learning_rate = tf.train.piecewise_constant(
+            self.global_step % self.cfg['training']['total_steps'],
+            self.cfg['training']['lr_boundaries'],
+            self.cfg['training']['lr_values'])
 
         # You need to change the learning rate here if you are training
         # from a self-play training set, for example start with 0.005 instead.
@@ -122,40 +166,136 @@ class TFProcess:
             learning_rate=self.learning_rate, momentum=0.9, use_nesterov=True)
 
 
+        # Average the training losses in the graph, so a training step
+        # doesn't copy anything back to the host.
+        accumulate, self.avg_losses = self.running_average(
+            [self.policy_loss, self.mse_loss, self.reg_term])
+
+        # fp16 gradients underflow, so scale the loss up for the backward
+        # pass and the gradients back down before applying them.
+        loss_scale = 1.0
+        if self.model_dtype == tf.float16:
+            loss_scale = self.cfg['training'].get('loss_scale', 128.0)
+
+        # With accumulate_steps > 1, the gradients of that many batches are
+        # summed and applied together, for a bigger effective batch than
+        # fits in GPU memory.
+        self.accumulate_steps = self.cfg['training'].get('accumulate_steps', 1)
+        train_vars = tf.trainable_variables()
+        grad_sums = []
+        if self.accumulate_steps > 1:
+            grad_sums = [tf.Variable(tf.zeros(var.shape), trainable=False,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                     use_resource=True)
+                         for var in train_vars]
+
         self.update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(self.update_ops):
-            self.train_op = \
-                opt_op.minimize(loss, global_step=self.global_step)
+            grads_and_vars = opt_op.compute_gradients(loss * loss_scale,
+                                                      var_list=train_vars)
+            if loss_scale != 1.0:
+                grads_and_vars = [(grad / loss_scale, var)
+                                  for grad, var in grads_and_vars]
+            if grad_sums:
+                self.accumulate_op = tf.group(accumulate, *[
+                    tf.assign_add(grad_sum, grad) for grad_sum, (grad, _)
+                    in zip(grad_sums, grads_and_vars)])
+                grads_and_vars = [
+                    ((grad_sum + grad) / self.accumulate_steps, var)
+                    for grad_sum, (grad, var) in zip(grad_sums, grads_and_vars)]
+            minimize = opt_op.apply_gradients(grads_and_vars,
+                                              global_step=self.global_step)
+            if grad_sums:
+                with tf.control_dependencies([minimize]):
+                    minimize = tf.group(*[
+                        tf.assign(grad_sum, tf.zeros_like(grad_sum))
+                        for grad_sum in grad_sums])
+            self.train_op = tf.group(minimize, accumulate)
+        # The incremented step, read back as part of the training run.
+        with tf.control_dependencies([self.train_op]):
+            self.step = self.global_step.read_value()
 
         correct_prediction = \
             tf.equal(tf.argmax(self.y_conv, 1), tf.argmax(self.y_, 1))
         correct_prediction = tf.cast(correct_prediction, tf.float32)
         self.accuracy = tf.reduce_mean(correct_prediction)
 
-        self.avg_policy_loss = []
-        self.avg_mse_loss = []
-        self.avg_reg_term = []
+        # Likewise for the test batches, which are only read back once
+        # all of them have run.
+        self.test_op, self.avg_test = self.running_average(
+            [self.policy_loss, self.accuracy, self.mse_loss])
+
         self.time_start = None
 
-        # Summary part
+        # Summary part. Serializing the graph is slow for big networks, so
+        # it is only logged on request, and only once.
+        graph = self.session.graph if self.cfg['training'].get('log_graph', False) else None
         self.test_writer = tf.summary.FileWriter(
-            os.path.join(os.getcwd(), "leelalogs/{}-test".format(self.cfg['name'])), self.session.graph)
+            os.path.join(os.getcwd(), "leelalogs/{}-test".format(self.cfg['name'])))
         self.train_writer = tf.summary.FileWriter(
-            os.path.join(os.getcwd(), "leelalogs/{}-train".format(self.cfg['name'])), self.session.graph)
-
-        self.init = tf.global_variables_initializer()
+            os.path.join(os.getcwd(), "leelalogs/{}-train".format(self.cfg['name'])), graph)
+
+        # Tensors in Leela's layout for save_leelaz_weights, and assign ops
+        # for replace_weights. Built once here, so exporting and restoring
+        # weights don't grow the graph.
+        self.export_weights = []
+        for weights in self.weights:
+            if weights.shape.ndims == 4:
+                # Convolution weights need a transpose
+                #
+                # TF (kYXInputOutput)
+                # [filter_height, filter_width, in_channels, out_channels]
+                #
+                # Leela/cuDNN/Caffe (kOutputInputYX)
+                # [output, input, filter_size, filter_size]
+                self.export_weights.append(tf.transpose(weights, [3, 2, 0, 1]))
+            elif weights.shape.ndims == 2:
+                # Fully connected layers are [in, out] in TF
+                #
+                # [out, in] in Leela
+                #
+                self.export_weights.append(tf.transpose(weights, [1, 0]))
+            else:
+                # Biases, batchnorm etc
+                self.export_weights.append(weights)
+        self.assign_placeholders = []
+        self.assign_ops = []
+        for weights in self.weights:
+            placeholder = tf.placeholder(weights.dtype.base_dtype, weights.shape)
+            self.assign_placeholders.append(placeholder)
+            self.assign_ops.append(tf.assign(weights, placeholder))
+
+        self.init = tf.group(tf.global_variables_initializer(),
+                             tf.local_variables_initializer())
         self.saver = tf.train.Saver()
 
         self.session.run(self.init)
 
+    def running_average(self, values):
+        """
+        Keep running sums of the scalar tensors 'values' in the graph.
+
+        Returns an op adding the current values to the sums, and a tensor
+        that evaluates to the averages since it was last evaluated and
+        resets the sums. The sums are local variables, so they are not
+        saved in checkpoints.
+        """
+        sums = tf.Variable(tf.zeros([len(values) + 1]), trainable=False,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                           use_resource=True)
+        accumulate = tf.assign_add(sums, tf.stack(values + [1.0])).op
+        average = sums[:-1] / tf.maximum(sums[-1], 1.0)
+        with tf.control_dependencies([average]):
+            reset = tf.assign(sums, tf.zeros_like(sums))
+        with tf.control_dependencies([reset]):
+            average = tf.identity(average)
+        return accumulate, average
+
     def replace_weights(self, new_weights):
-        for e, weights in enumerate(self.weights):
-            # Keyed batchnorm weights
-            if isinstance(weights, str):
-                work_weights = tf.get_default_graph().get_tensor_by_name(weights)
-                new_weight = tf.constant(new_weights[e])
-                self.session.run(tf.assign(work_weights, new_weight))
-            elif weights.shape.ndims == 4:
+        feed_dict = {}
+        for placeholder, new_weight in zip(self.assign_placeholders, new_weights):
+            s = placeholder.shape.as_list()
+            if placeholder.shape.ndims == 4:
                 # Convolution weights need a transpose
                 #
                 # TF (kYXInputOutput)
@@ -163,24 +303,22 @@ class TFProcess:
                 #
                 # Leela/cuDNN/Caffe (kOutputInputYX)
                 # [output, input, filter_size, filter_size]
-                s = weights.shape.as_list()
                 shape = [s[i] for i in [3, 2, 0, 1]]
-                new_weight = tf.constant(new_weights[e], shape=shape)
-                self.session.run(weights.assign(tf.transpose(new_weight, [2, 3, 1, 0])))
-            elif weights.shape.ndims == 2:
+                new_weight = np.reshape(new_weight, shape).transpose([2, 3, 1, 0])
+            elif placeholder.shape.ndims == 2:
                 # Fully connected layers are [in, out] in TF
                 #
                 # [out, in] in Leela
                 #
-                s = weights.shape.as_list()
                 shape = [s[i] for i in [1, 0]]
-                new_weight = tf.constant(new_weights[e], shape=shape)
-                self.session.run(weights.assign(tf.transpose(new_weight, [1, 0])))
+                new_weight = np.reshape(new_weight, shape).transpose([1, 0])
             else:
                 # Biases, batchnorm etc
-                new_weight = tf.constant(new_weights[e], shape=weights.shape)
-                self.session.run(weights.assign(new_weight))
-        #This should result in identical file to the starting one
+                new_weight = np.reshape(new_weight, s)
+            feed_dict[placeholder] = new_weight
+        self.session.run(self.assign_ops, feed_dict=feed_dict)
+        #This should result in identical file to the starting one, as
+        #every float32 is written in its shortest round trip form
         #self.save_leelaz_weights('restored.txt')
 
     def restore(self, file):
@@ -188,43 +326,33 @@ class TFProcess:
         self.saver.restore(self.session, file)
 
     def process(self, batch_size, test_batches):
+        # Run training for this batch, after accumulating the gradients of
+        # the preceding ones.
+        for _ in range(1, self.accumulate_steps):
+            self.accumulate_step(True, self.train_handle)
+        _, steps = self.train_step(True, self.train_handle)
+
         if not self.time_start:
-            self.time_start = time.time()
-
-        # Run training for this batch
-        policy_loss, mse_loss, reg_term, _, _ = self.session.run(
-            [self.policy_loss, self.mse_loss, self.reg_term, self.train_op,
-                self.next_batch],
-            feed_dict={self.training: True, self.learning_rate: self.lr, self.handle: self.train_handle})
-
-        steps = tf.train.global_step(self.session, self.global_step)
-
-        # Determine learning rate
-        lr_values = self.cfg['training']['lr_values']
-        lr_boundaries = self.cfg['training']['lr_boundaries']
-        steps_total = (steps-1) % self.cfg['training']['total_steps']
-        self.lr = lr_values[bisect.bisect_right(lr_boundaries, steps_total)]
-
-        # Keep running averages
-        # Google's paper scales MSE by 1/4 to a [0, 1] range, so do the same to
-        # get comparable values.
-        mse_loss /= 4.0
-        self.avg_policy_loss.append(policy_loss)
-        self.avg_mse_loss.append(mse_loss)
-        self.avg_reg_term.append(reg_term)
+            # Start timing after the first step, which compiles the graph.
+            self.time_start = time.perf_counter()
+            self.steps_start = steps
+
         if steps % NUM_STEP_TRAIN == 0:
             pol_loss_w = self.cfg['training']['policy_loss_weight']
             val_loss_w = self.cfg['training']['value_loss_weight']
-            time_end = time.time()
+            time_end = time.perf_counter()
             speed = 0
-            if self.time_start:
+            if steps > self.steps_start:
                 elapsed = time_end - self.time_start
-                speed = batch_size * (NUM_STEP_TRAIN / elapsed)
-            avg_policy_loss = np.mean(self.avg_policy_loss or [0])
-            avg_mse_loss = np.mean(self.avg_mse_loss or [0])
-            avg_reg_term = np.mean(self.avg_reg_term or [0])
+                speed = batch_size * self.accumulate_steps * \
+                    (steps - self.steps_start) / elapsed
+            (avg_policy_loss, avg_mse_loss, avg_reg_term), lr = \
+                self.session.run([self.avg_losses, self.learning_rate])
+            # Google's paper scales MSE by 1/4 to a [0, 1] range, so do the
+            # same to get comparable values.
+            avg_mse_loss /= 4.0
             print("step {}, lr={:g} policy={:g} mse={:g} reg={:g} total={:g} ({:g} pos/s)".format(
-                steps, self.lr, avg_policy_loss, avg_mse_loss, avg_reg_term,
+                steps, lr, avg_policy_loss, avg_mse_loss, avg_reg_term,
                 # Scale mse_loss back to the original to reflect the actual
                 # value being optimized.
                 # If you changed the factor in the loss formula above, you need
@@ -237,26 +365,16 @@ class TFProcess:
                 tf.Summary.Value(tag="MSE Loss", simple_value=avg_mse_loss)])
             self.train_writer.add_summary(train_summaries, steps)
             self.time_start = time_end
-            self.avg_policy_loss, self.avg_mse_loss, self.avg_reg_term = [], [], []
+            self.steps_start = steps
 
         if steps % NUM_STEP_TEST == 0:
-            sum_accuracy = 0
-            sum_mse = 0
-            sum_policy = 0
             for _ in range(0, test_batches):
-                test_policy, test_accuracy, test_mse, _ = self.session.run(
-                    [self.policy_loss, self.accuracy, self.mse_loss,
-                     self.next_batch],
-                    feed_dict={self.training: False,
-                               self.handle: self.test_handle})
-                sum_accuracy += test_accuracy
-                sum_mse += test_mse
-                sum_policy += test_policy
-            sum_accuracy /= test_batches
+                self.test_step(False, self.test_handle)
+            sum_policy, sum_accuracy, sum_mse = \
+                self.session.run(self.avg_test)
             sum_accuracy *= 100
-            sum_policy /= test_batches
             # Additionally rescale to [0, 1] so divide by 4
-            sum_mse /= (4.0 * test_batches)
+            sum_mse /= 4.0
             test_summaries = tf.Summary(value=[
                 tf.Summary.Value(tag="Accuracy", simple_value=sum_accuracy),
                 tf.Summary.Value(tag="Policy Loss", simple_value=sum_policy),
@@ -274,64 +392,90 @@ class TFProcess:
             print("Weights saved in file: {}".format(leela_path))
 
     def save_leelaz_weights(self, filename):
+        # Fetch everything in one go rather than a run per tensor.
+        nparrays = self.session.run(self.export_weights)
         with open(filename, "w") as file:
             # Version tag
             file.write("{}".format(VERSION))
-            for weights in self.weights:
+            for nparray in nparrays:
                 # Newline unless last line (single bias)
                 file.write("\n")
-                work_weights = None
-                # Keyed batchnorm weights
-                if isinstance(weights, str):
-                    work_weights = tf.get_default_graph().get_tensor_by_name(weights)
-                elif weights.shape.ndims == 4:
-                    # Convolution weights need a transpose
-                    #
-                    # TF (kYXInputOutput)
-                    # [filter_height, filter_width, in_channels, out_channels]
-                    #
-                    # Leela/cuDNN/Caffe (kOutputInputYX)
-                    # [output, input, filter_size, filter_size]
-                    work_weights = tf.transpose(weights, [3, 2, 0, 1])
-                elif weights.shape.ndims == 2:
-                    # Fully connected layers are [in, out] in TF
-                    #
-                    # [out, in] in Leela
-                    #
-                    work_weights = tf.transpose(weights, [1, 0])
-                else:
-                    # Biases, batchnorm etc
-                    work_weights = weights
-                nparray = work_weights.eval(session=self.session)
-                wt_str = [str(wt) for wt in np.ravel(nparray)]
+                # Shortest text that round trips each float32, formatted
+                # by numpy in one call rather than str() per element.
+                wt_str = np.ravel(nparray).astype(str).tolist()
                 file.write(" ".join(wt_str))
 
+    def jit_scope(self):
+        """
+        Mark the ops created in this scope as one XLA cluster.
+        """
+        return jit.experimental_jit_scope(compile_ops=self.xla)
+
     def get_batchnorm_key(self):
         result = "bn" + str(self.batch_norm_count)
         self.batch_norm_count += 1
         return result
 
+    def batchnorm_variables(self, channels):
+        """
+        Create the moving mean and variance of a batchnorm layer.
+
+        They are put in a unique scope under the names tf.layers used, so
+        existing checkpoints still restore.
+        """
+        weight_key = self.get_batchnorm_key()
+        with tf.variable_scope(weight_key), \
+             tf.variable_scope("batch_normalization"):
+            mean = tf.get_variable("moving_mean", [channels],
+                                   initializer=tf.zeros_initializer(),
+                                   trainable=False, use_resource=True)
+            variance = tf.get_variable("moving_variance", [channels],
+                                       initializer=tf.ones_initializer(),
+                                       trainable=False, use_resource=True)
+        self.weights.append(mean)
+        self.weights.append(variance)
+        return mean, variance
+
+    def batch_norm(self, inputs, moving_mean, moving_variance):
+        """
+        Fused batchnorm without scale or offset.
+        """
+        scale = tf.ones(moving_mean.shape)
+        offset = tf.zeros(moving_mean.shape)
+
+        def train_bn():
+            return tf.nn.fused_batch_norm(
+                inputs, scale, offset, epsilon=1e-5,
+                data_format='NHWC', is_training=True)
+
+        def test_bn():
+            h_bn, _, _ = tf.nn.fused_batch_norm(
+                inputs, scale, offset, mean=moving_mean,
+                variance=moving_variance, epsilon=1e-5,
+                data_format='NHWC', is_training=False)
+            return h_bn, tf.identity(moving_mean), tf.identity(moving_variance)
+
+        h_bn, mean, variance = tf.cond(self.training, train_bn, test_bn)
+        # Outside of training mean and variance are the moving averages
+        # themselves, so these updates are no-ops.
+        decay = 0.99
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign_sub(
+            moving_mean, (moving_mean - mean) * (1 - decay)))
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign_sub(
+            moving_variance, (moving_variance - variance) * (1 - decay)))
+        return h_bn
+
     def conv_block(self, inputs, filter_size, input_channels, output_channels):
         W_conv = weight_variable([filter_size, filter_size,
                                   input_channels, output_channels])
         b_conv = bn_bias_variable([output_channels])
         self.weights.append(W_conv)
         self.weights.append(b_conv)
-        # The weights are internal to the batchnorm layer, so apply
-        # a unique scope that we can store, and use to look them back up
-        # later on.
-        weight_key = self.get_batchnorm_key()
-        self.weights.append(weight_key + "/batch_normalization/moving_mean:0")
-        self.weights.append(weight_key + "/batch_normalization/moving_variance:0")
-
-        with tf.variable_scope(weight_key):
-            h_bn = \
-                tf.layers.batch_normalization(
-                    conv2d(inputs, W_conv),
-                    epsilon=1e-5, axis=1, fused=True,
-                    center=False, scale=False,
-                    training=self.training)
-        h_conv = tf.nn.relu(h_bn)
+        mean, variance = self.batchnorm_variables(output_channels)
+
+        with self.jit_scope():
+            h_bn = self.batch_norm(conv2d(inputs, W_conv), mean, variance)
+            h_conv = tf.nn.relu(h_bn)
         return h_conv
 
     def residual_block(self, inputs, channels):
@@ -341,41 +485,31 @@ class TFProcess:
         b_conv_1 = bn_bias_variable([channels])
         self.weights.append(W_conv_1)
         self.weights.append(b_conv_1)
-        weight_key_1 = self.get_batchnorm_key()
-        self.weights.append(weight_key_1 + "/batch_normalization/moving_mean:0")
-        self.weights.append(weight_key_1 + "/batch_normalization/moving_variance:0")
+        mean_1, variance_1 = self.batchnorm_variables(channels)
 
         # Second convnet
         W_conv_2 = weight_variable([3, 3, channels, channels])
         b_conv_2 = bn_bias_variable([channels])
         self.weights.append(W_conv_2)
         self.weights.append(b_conv_2)
-        weight_key_2 = self.get_batchnorm_key()
-        self.weights.append(weight_key_2 + "/batch_normalization/moving_mean:0")
-        self.weights.append(weight_key_2 + "/batch_normalization/moving_variance:0")
-
-        with tf.variable_scope(weight_key_1):
-            h_bn1 = \
-                tf.layers.batch_normalization(
-                    conv2d(inputs, W_conv_1),
-                    epsilon=1e-5, axis=1, fused=True,
-                    center=False, scale=False,
-                    training=self.training)
-        h_out_1 = tf.nn.relu(h_bn1)
-        with tf.variable_scope(weight_key_2):
-            h_bn2 = \
-                tf.layers.batch_normalization(
-                    conv2d(h_out_1, W_conv_2),
-                    epsilon=1e-5, axis=1, fused=True,
-                    center=False, scale=False,
-                    training=self.training)
-        h_out_2 = tf.nn.relu(tf.add(h_bn2, orig))
+        mean_2, variance_2 = self.batchnorm_variables(channels)
+
+        with self.jit_scope():
+            h_bn1 = self.batch_norm(conv2d(inputs, W_conv_1),
+                                    mean_1, variance_1)
+            h_out_1 = tf.nn.relu(h_bn1)
+            h_bn2 = self.batch_norm(conv2d(h_out_1, W_conv_2),
+                                    mean_2, variance_2)
+            h_out_2 = tf.nn.relu(tf.add(h_bn2, orig))
         return h_out_2
 
     def construct_net(self, planes):
-        # NCHW format
-        # batch, 112 input channels, 8 x 8
-        x_planes = tf.reshape(planes, [-1, 112, 8, 8])
+        # NHWC format
+        # batch, 8 x 8, 112 input channels
+        # Input planes arrive bit packed, unpack and cast them on the GPU.
+        with self.jit_scope():
+            x_planes = ChunkParser.unpack_planes(planes)
+            x_planes = tf.cast(tf.reshape(x_planes, [-1, 8, 8, 112]), self.model_dtype)
 
         # Input convolution
         flow = self.conv_block(x_planes, filter_size=3,
@@ -389,27 +523,38 @@ class TFProcess:
         conv_pol = self.conv_block(flow, filter_size=1,
                                    input_channels=self.RESIDUAL_FILTERS,
                                    output_channels=32)
-        h_conv_pol_flat = tf.reshape(conv_pol, [-1, 32*8*8])
         W_fc1 = weight_variable([32*8*8, 1858])
         b_fc1 = bias_variable([1858])
         self.weights.append(W_fc1)
         self.weights.append(b_fc1)
-        h_fc1 = tf.add(tf.matmul(h_conv_pol_flat, W_fc1), b_fc1, name='policy_head')
+        with self.jit_scope():
+            h_conv_pol_flat = tf.reshape(conv_pol, [-1, 8*8*32])
+            h_fc1 = tf.nn.xw_plus_b(
+                h_conv_pol_flat, tf.cast(nhwc_rows(W_fc1, 32), self.model_dtype),
+                tf.cast(b_fc1, self.model_dtype))
+            # The losses are computed in fp32.
+            h_fc1 = tf.identity(tf.cast(h_fc1, tf.float32), name='policy_head')
 
         # Value head
         conv_val = self.conv_block(flow, filter_size=1,
                                    input_channels=self.RESIDUAL_FILTERS,
                                    output_channels=32)
-        h_conv_val_flat = tf.reshape(conv_val, [-1, 32*8*8])
         W_fc2 = weight_variable([32 * 8 * 8, 128])
         b_fc2 = bias_variable([128])
         self.weights.append(W_fc2)
         self.weights.append(b_fc2)
-        h_fc2 = tf.nn.relu(tf.add(tf.matmul(h_conv_val_flat, W_fc2), b_fc2))
         W_fc3 = weight_variable([128, 1])
         b_fc3 = bias_variable([1])
         self.weights.append(W_fc3)
         self.weights.append(b_fc3)
-        h_fc3 = tf.nn.tanh(tf.add(tf.matmul(h_fc2, W_fc3), b_fc3), name='value_head')
+        with self.jit_scope():
+            h_conv_val_flat = tf.reshape(conv_val, [-1, 8*8*32])
+            h_fc2 = tf.nn.relu(tf.nn.xw_plus_b(
+                h_conv_val_flat, tf.cast(nhwc_rows(W_fc2, 32), self.model_dtype),
+                tf.cast(b_fc2, self.model_dtype)))
+            h_fc3 = tf.nn.tanh(tf.nn.xw_plus_b(
+                h_fc2, tf.cast(W_fc3, self.model_dtype),
+                tf.cast(b_fc3, self.model_dtype)))
+            h_fc3 = tf.identity(tf.cast(h_fc3, tf.float32), name='value_head')
 
         return h_fc1, h_fc3
@@ -21,12 +21,11 @@ import os
 import yaml
 import sys
 import glob
-import gzip
+import heapq
 import random
 import multiprocessing as mp
-import tensorflow as tf
-from tfprocess import TFProcess
-from chunkparser import ChunkParser
+from concurrent.futures import ThreadPoolExecutor
+from chunkparser import ChunkParser, FileDataSrc
 
 SKIP = 16
 
@@ -38,52 +37,48 @@ def get_checkpoint(root_dir):
 
 
 def get_chunks(data_prefix):
-    return glob.glob(data_prefix + "*.gz")
+    """
+        (mtime, filename) of the chunks starting with data_prefix. scandir
+        lists the names and stats in one pass over the directory.
+    """
+    directory, prefix = os.path.split(data_prefix)
+    with os.scandir(directory or '.') as entries:
+        return [(entry.stat().st_mtime, os.path.join(directory, entry.name))
+                for entry in entries
+                if entry.name.startswith(prefix) and entry.name.endswith('.gz')]
 
 
 def get_latest_chunks(path, num_chunks):
     chunks = []
-    for d in glob.glob(path):
-        chunks += get_chunks(d)
+    # stat releases the GIL, so list the directories concurrently.
+    with ThreadPoolExecutor(32) as executor:
+        for dir_chunks in executor.map(get_chunks, glob.glob(path)):
+            chunks += dir_chunks
 
     if len(chunks) < num_chunks:
         print("Not enough chunks")
         sys.exit(1)
 
     print("sorting {} chunks...".format(len(chunks)), end='')
-    chunks.sort(key=os.path.getmtime, reverse=True)
+    chunks = heapq.nlargest(num_chunks, chunks)
     print("[done]")
-    chunks = chunks[:num_chunks]
+    chunks = [chunk for _, chunk in chunks]
     print("{} - {}".format(os.path.basename(chunks[-1]), os.path.basename(chunks[0])))
     random.shuffle(chunks)
     return chunks
 
 
-class FileDataSrc:
-    """
-        data source yielding chunkdata from chunk files.
-    """
-    def __init__(self, chunks):
-        self.chunks = []
-        self.done = chunks
-    def next(self):
-        if not self.chunks:
-            self.chunks, self.done = self.done, self.chunks
-            random.shuffle(self.chunks)
-        if not self.chunks:
-            return None
-        while len(self.chunks):
-            filename = self.chunks.pop()
-            try:
-                with gzip.open(filename, 'rb') as chunk_file:
-                    self.done.append(filename)
-                    return chunk_file.read()
-            except:
-                print("failed to parse {}".format(filename))
-
-
 def main(cmd):
-    cfg = yaml.safe_load(cmd.cfg.read())
+    # The parser workers import this file again, so TensorFlow is only
+    # imported here, in the main process.
+    import tensorflow as tf
+    from tfprocess import TFProcess
+    from tfdataset import make_dataset, make_record_dataset
+
+    # libyaml's loader when PyYAML was built with it.
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with cmd.cfg:
+        cfg = yaml.load(cmd.cfg, Loader=loader)
     print(yaml.dump(cfg, default_flow_style=False))
 
     num_chunks = cfg['dataset']['num_chunks']
@@ -98,22 +93,32 @@ def main(cmd):
     if not os.path.exists(root_dir):
         os.makedirs(root_dir)
 
-    train_parser = ChunkParser(FileDataSrc(chunks[:num_train]),
-            shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
-    dataset = tf.data.Dataset.from_generator(
-        train_parser.parse, output_types=(tf.string, tf.string, tf.string))
-    dataset = dataset.map(ChunkParser.parse_function)
-    dataset = dataset.prefetch(4)
-    train_iterator = dataset.make_one_shot_iterator()
+    native_reader = cfg['dataset'].get('native_reader', False)
+    parsers = []
+    if native_reader:
+        dataset = make_record_dataset(chunks[:num_train], shuffle_size, SKIP)
+    else:
+        # Only the training set is cached, the test set is sampled much less.
+        train_src = FileDataSrc(chunks[:num_train],
+                                cfg['dataset'].get('cache_dir'))
+        train_src.prune_cache()
+        train_parser = ChunkParser(train_src,
+                shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
+        parsers.append(train_parser)
+        dataset = make_dataset(train_parser)
+    with tf.device('/gpu:0'):
+        train_iterator = dataset.make_one_shot_iterator()
 
     shuffle_size = int(shuffle_size*(1.0-train_ratio))
-    test_parser = ChunkParser(FileDataSrc(chunks[num_train:]), 
-            shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
-    dataset = tf.data.Dataset.from_generator(
-        test_parser.parse, output_types=(tf.string, tf.string, tf.string))
-    dataset = dataset.map(ChunkParser.parse_function)
-    dataset = dataset.prefetch(4)
-    test_iterator = dataset.make_one_shot_iterator()
+    if native_reader:
+        dataset = make_record_dataset(chunks[num_train:], shuffle_size, SKIP)
+    else:
+        test_parser = ChunkParser(FileDataSrc(chunks[num_train:]), 
+                shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
+        parsers.append(test_parser)
+        dataset = make_dataset(test_parser)
+    with tf.device('/gpu:0'):
+        test_iterator = dataset.make_one_shot_iterator()
 
     tfprocess = TFProcess(cfg)
     tfprocess.init(dataset, train_iterator, test_iterator)
@@ -123,7 +128,7 @@ def main(cmd):
         tfprocess.restore(cp)
 
     # Sweeps through all test chunks statistically
-    num_evals = (num_chunks-num_train)*10 // ChunkParser.BATCH_SIZE
+    num_evals = max(1, (num_chunks-num_train)*10 // ChunkParser.BATCH_SIZE)
     print("Using {} evaluation batches".format(num_evals))
 
     for _ in range(cfg['training']['total_steps']):
@@ -132,8 +137,8 @@ def main(cmd):
     tfprocess.save_leelaz_weights(cmd.output)
 
     tfprocess.session.close()
-    train_parser.shutdown()
-    test_parser.shutdown()
+    for parser in parsers:
+        parser.shutdown()
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(description=\
@@ -143,6 +148,13 @@ if __name__ == "__main__":
     argparser.add_argument('--output', type=str, 
         help='file to store weights in')
 
-    mp.set_start_method('spawn')
+    # Fork the parser workers from a server that has already imported
+    # chunkparser, instead of starting a fresh interpreter for every worker.
+    # forkserver isn't available on Windows.
+    if 'forkserver' in mp.get_all_start_methods():
+        mp.set_start_method('forkserver')
+        mp.set_forkserver_preload(['chunkparser'])
+    else:
+        mp.set_start_method('spawn')
     main(argparser.parse_args())
     mp.freeze_support()